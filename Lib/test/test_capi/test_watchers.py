@@ -1,349 +1,490 @@
+import sys
+import threading
 import unittest
 
-from contextlib import contextmanager, ExitStack
-from test.support import catch_unraisable_exception, import_helper
+from test.support import import_helper, threading_helper
 
 
 # Skip this test if the _testcapi module isn't available.
 _testcapi = import_helper.import_module('_testcapi')
 
 
-class TestDictWatchers(unittest.TestCase):
+class _UnraisableCollector:
+    # sys.unraisablehook for a test that expects one unraisable exception;
+    # anything raised after that is passed on to the previous hook.
+    def __init__(self, old_hook):
+        self.last = None
+        self.old_hook = old_hook
+
+    def __call__(self, unraisable):
+        if self.last is None:
+            self.last = unraisable
+        else:
+            self.old_hook(unraisable)
+
+    def restore(self):
+        sys.unraisablehook = self.old_hook
+        # break the reference cycle through the exception's traceback
+        self.last = None
+
+
+class _WatcherCM:
+    # Registers a watcher on entry and clears it on exit; a plain class
+    # is cheaper to enter than a @contextmanager generator.
+    __slots__ = ("add", "clear", "arg", "wid")
+
+    def __init__(self, add, clear, arg):
+        self.add = add
+        self.clear = clear
+        self.arg = arg
+
+    def __enter__(self):
+        self.wid = self.add(self.arg)
+        return self.wid
+
+    def __exit__(self, *exc_info):
+        self.clear(self.wid)
+
+
+class _WatcherTestCase(unittest.TestCase):
+    def assert_raises_msg(self, exc, msg, func, *args):
+        # the expected messages are plain strings, so compare them exactly
+        # rather than compiling a regex for each assertRaisesRegex() call
+        with self.assertRaises(exc) as cm:
+            func(*args)
+        self.assertEqual(str(cm.exception), msg)
+
+    def catch_unraisable(self):
+        # Install a collector until the end of the test.  Call this before
+        # adding watchers so that the hook is restored after they're cleared.
+        collector = _UnraisableCollector(sys.unraisablehook)
+        sys.unraisablehook = collector
+        self.addCleanup(collector.restore)
+        return collector
+
+
+class TestDictWatchers(_WatcherTestCase):
     # types of watchers testcapimodule can add:
-    EVENTS = 0   # appends dict events as strings to global event list
+    EVENTS = 0   # appends (event, key, value) tuples to global event list
     ERROR = 1    # unconditionally sets and signals a RuntimeException
     SECOND = 2   # always appends "second" to global event list
 
+    # dict watch events, as reported by the EVENTS watcher
+    ADDED = _testcapi.PYDICT_EVENT_ADDED
+    MODIFIED = _testcapi.PYDICT_EVENT_MODIFIED
+    DELETED = _testcapi.PYDICT_EVENT_DELETED
+    CLONED = _testcapi.PYDICT_EVENT_CLONED
+    CLEARED = _testcapi.PYDICT_EVENT_CLEARED
+    DEALLOCATED = _testcapi.PYDICT_EVENT_DEALLOCATED
+
+    _add_watcher = staticmethod(_testcapi.add_dict_watcher)
+    _clear_watcher = staticmethod(_testcapi.clear_dict_watcher)
+    _watch = staticmethod(_testcapi.watch_dict)
+    _unwatch = staticmethod(_testcapi.unwatch_dict)
+
     def add_watcher(self, kind=EVENTS):
-        return _testcapi.add_dict_watcher(kind)
+        return self._add_watcher(kind)
 
     def clear_watcher(self, watcher_id):
-        _testcapi.clear_dict_watcher(watcher_id)
+        self._clear_watcher(watcher_id)
 
-    @contextmanager
     def watcher(self, kind=EVENTS):
-        wid = self.add_watcher(kind)
-        try:
-            yield wid
-        finally:
-            self.clear_watcher(wid)
+        return _WatcherCM(self.add_watcher, self.clear_watcher, kind)
 
     def assert_events(self, expected):
-        actual = _testcapi.get_dict_watcher_events()
-        self.assertEqual(actual, expected)
+        if not expected:
+            if not _testcapi.dict_watcher_events_empty():
+                self.fail(f"unexpected events: "
+                          f"{_testcapi.get_dict_watcher_events()!r}")
+        else:
+            # the event buffer has a fixed size; make sure none were lost
+            self.assertEqual(_testcapi.get_dict_watcher_dropped_events(), 0)
+            actual = _testcapi.get_dict_watcher_events()
+            self.assertEqual(actual, expected)
+
+    def setUp(self):
+        _testcapi.reset_dict_watcher_events()
 
     def watch(self, wid, d):
-        _testcapi.watch_dict(wid, d)
+        self._watch(wid, d)
 
     def unwatch(self, wid, d):
-        _testcapi.unwatch_dict(wid, d)
+        self._unwatch(wid, d)
 
     def test_set_new_item(self):
         d = {}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            d["foo"] = "bar"
-            self.assert_events(["new:foo:bar"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        d["foo"] = "bar"
+        self.assert_events([(self.ADDED, "foo", "bar")])
 
     def test_set_existing_item(self):
         d = {"foo": "bar"}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            d["foo"] = "baz"
-            self.assert_events(["mod:foo:baz"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        d["foo"] = "baz"
+        self.assert_events([(self.MODIFIED, "foo", "baz")])
 
     def test_clone(self):
         d = {}
         d2 = {"foo": "bar"}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            d.update(d2)
-            self.assert_events(["clone"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        d.update(d2)
+        self.assert_events([(self.CLONED, d2, None)])
 
     def test_no_event_if_not_watched(self):
         d = {}
-        with self.watcher() as wid:
-            d["foo"] = "bar"
-            self.assert_events([])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        d["foo"] = "bar"
+        self.assert_events([])
 
     def test_del(self):
         d = {"foo": "bar"}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            del d["foo"]
-            self.assert_events(["del:foo"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        del d["foo"]
+        self.assert_events([(self.DELETED, "foo", None)])
 
     def test_pop(self):
         d = {"foo": "bar"}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            d.pop("foo")
-            self.assert_events(["del:foo"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        d.pop("foo")
+        self.assert_events([(self.DELETED, "foo", None)])
 
     def test_clear(self):
         d = {"foo": "bar"}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            d.clear()
-            self.assert_events(["clear"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        d.clear()
+        self.assert_events([(self.CLEARED, None, None)])
 
     def test_dealloc(self):
-        d = {"foo": "bar"}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            del d
-            self.assert_events(["dealloc"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        # the dict is created, watched and released in C, so no frame or
+        # traceback can keep it alive past the point where it is dropped
+        events = _testcapi.watch_dict_and_dealloc(wid)
+        self.assertEqual(events, [(self.DEALLOCATED, None, None)])
 
     def test_unwatch(self):
         d = {}
-        with self.watcher() as wid:
-            self.watch(wid, d)
-            d["foo"] = "bar"
-            self.unwatch(wid, d)
-            d["hmm"] = "baz"
-            self.assert_events(["new:foo:bar"])
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        d["foo"] = "bar"
+        self.unwatch(wid, d)
+        d["hmm"] = "baz"
+        self.assert_events([(self.ADDED, "foo", "bar")])
+
+    def test_event_buffer_overflow(self):
+        d = {}
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        size = _testcapi.DICT_WATCH_EVENTS_SIZE
+        count = size + size // 2
+        for i in range(count):
+            d[i] = i
+        events = _testcapi.get_dict_watcher_events()
+        # only the newest events are kept; the rest are counted as dropped
+        self.assertEqual(len(events), size)
+        self.assertEqual(_testcapi.get_dict_watcher_dropped_events(),
+                         count - size)
+        self.assertEqual(events, [(self.ADDED, i, i)
+                                  for i in range(count - size, count)])
 
     def test_error(self):
         d = {}
-        with self.watcher(kind=self.ERROR) as wid:
-            self.watch(wid, d)
-            with catch_unraisable_exception() as cm:
-                d["foo"] = "bar"
-                self.assertIs(cm.unraisable.object, d)
-                self.assertEqual(str(cm.unraisable.exc_value), "boom!")
-            self.assert_events([])
+        unraisable = self.catch_unraisable()
+        wid = self.add_watcher(kind=self.ERROR)
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, d)
+        d["foo"] = "bar"
+        self.assertIsNotNone(unraisable.last)
+        self.assertIs(unraisable.last.object, d)
+        self.assertEqual(str(unraisable.last.exc_value), "boom!")
+        self.assert_events([])
 
     def test_two_watchers(self):
         d1 = {}
         d2 = {}
-        with self.watcher() as wid1:
-            with self.watcher(kind=self.SECOND) as wid2:
-                self.watch(wid1, d1)
-                self.watch(wid2, d2)
-                d1["foo"] = "bar"
-                d2["hmm"] = "baz"
-                self.assert_events(["new:foo:bar", "second"])
-
-    def test_watch_non_dict(self):
-        with self.watcher() as wid:
-            with self.assertRaisesRegex(ValueError, r"Cannot watch non-dictionary"):
-                self.watch(wid, 1)
-
-    def test_watch_out_of_range_watcher_id(self):
-        d = {}
-        with self.assertRaisesRegex(ValueError, r"Invalid dict watcher ID -1"):
-            self.watch(-1, d)
-        with self.assertRaisesRegex(ValueError, r"Invalid dict watcher ID 8"):
-            self.watch(8, d)  # DICT_MAX_WATCHERS = 8
-
-    def test_watch_unassigned_watcher_id(self):
-        d = {}
-        with self.assertRaisesRegex(ValueError, r"No dict watcher set for ID 1"):
-            self.watch(1, d)
-
-    def test_unwatch_non_dict(self):
+        wid1 = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid1)
+        wid2 = self.add_watcher(kind=self.SECOND)
+        self.addCleanup(self.clear_watcher, wid2)
+        self.watch(wid1, d1)
+        self.watch(wid2, d2)
+        d1["foo"] = "bar"
+        d2["hmm"] = "baz"
+        self.assert_events([(self.ADDED, "foo", "bar"), "second"])
+
+    def test_api_errors(self):
         with self.watcher() as wid:
-            with self.assertRaisesRegex(ValueError, r"Cannot watch non-dictionary"):
-                self.unwatch(wid, 1)
-
-    def test_unwatch_out_of_range_watcher_id(self):
+            for func in (self.watch, self.unwatch):
+                with self.subTest(func=func.__name__):
+                    self.assert_raises_msg(
+                        ValueError, "Cannot watch non-dictionary", func, wid, 1)
+
+
+@threading_helper.requires_working_threading()
+class TestDictWatchersThreaded(unittest.TestCase):
+    NTHREADS = 4
+    # every thread stores each key once, so all events fit in the buffer
+    NITERS = _testcapi.DICT_WATCH_EVENTS_SIZE // NTHREADS
+
+    def setUp(self):
+        _testcapi.reset_dict_watcher_events()
+
+    def test_watch_unwatch_mutate(self):
+        # Several threads watch, mutate and unwatch the same dict at once.
+        # Another thread may unwatch the dict between a watch and the
+        # following mutation, so some events can be missed, but nothing may
+        # crash and the recorded events must be consistent with the order of
+        # the mutations.
         d = {}
-        with self.assertRaisesRegex(ValueError, r"Invalid dict watcher ID -1"):
-            self.unwatch(-1, d)
-        with self.assertRaisesRegex(ValueError, r"Invalid dict watcher ID 8"):
-            self.unwatch(8, d)  # DICT_MAX_WATCHERS = 8
-
-    def test_unwatch_unassigned_watcher_id(self):
-        d = {}
-        with self.assertRaisesRegex(ValueError, r"No dict watcher set for ID 1"):
-            self.unwatch(1, d)
-
-    def test_clear_out_of_range_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"Invalid dict watcher ID -1"):
-            self.clear_watcher(-1)
-        with self.assertRaisesRegex(ValueError, r"Invalid dict watcher ID 8"):
-            self.clear_watcher(8)  # DICT_MAX_WATCHERS = 8
-
-    def test_clear_unassigned_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"No dict watcher set for ID 1"):
-            self.clear_watcher(1)
-
+        wid = _testcapi.add_dict_watcher(TestDictWatchers.EVENTS)
+        self.addCleanup(_testcapi.clear_dict_watcher, wid)
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        barrier = threading.Barrier(self.NTHREADS)
+
+        def worker(n):
+            barrier.wait()
+            for i in range(self.NITERS):
+                _testcapi.watch_dict(wid, d)
+                # a new value each time, so that re-stores are reported
+                d[i] = (n, i)
+                _testcapi.unwatch_dict(wid, d)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(self.NTHREADS)]
+        with threading_helper.start_threads(threads):
+            pass
 
-class TestTypeWatchers(unittest.TestCase):
+        self.assertEqual(sorted(d), list(range(self.NITERS)))
+        for key, value in d.items():
+            self.assertEqual(value[1], key)
+        self.assertEqual(_testcapi.get_dict_watcher_dropped_events(), 0)
+        events = _testcapi.get_dict_watcher_events()
+        self.assertIn(TestDictWatchers.MODIFIED,
+                      [event for event, key, value in events])
+        events_by_key = {}
+        for event, key, value in events:
+            self.assertEqual(value[1], key)
+            events_by_key.setdefault(key, []).append((event, value[0]))
+        for key, key_events in events_by_key.items():
+            with self.subTest(key=key):
+                # only the first store can add the key, every later one
+                # modifies it; each thread stores it at most once
+                kinds = [event for event, n in key_events]
+                self.assertIn(kinds[0], (TestDictWatchers.ADDED,
+                                         TestDictWatchers.MODIFIED))
+                self.assertEqual(kinds[1:],
+                                 [TestDictWatchers.MODIFIED]
+                                 * (len(kinds) - 1))
+                writers = [n for event, n in key_events]
+                self.assertEqual(len(set(writers)), len(writers))
+
+        # each thread unwatched the dict after its last mutation
+        d["foo"] = "bar"
+        self.assertEqual(_testcapi.get_dict_watcher_events(), events)
+
+
+# Types shared by the type watcher tests that only set attributes, which
+# TestTypeWatchers._shared_type() removes again.  _C1 and _C2 must stay
+# unrelated to _C, since modifying a type also notifies its subclasses.
+class _C: pass
+class _D(_C): pass
+class _C1: pass
+class _C2: pass
+
+
+class TestTypeWatchers(_WatcherTestCase):
     # types of watchers testcapimodule can add:
     TYPES = 0    # appends modified types to global event list
     ERROR = 1    # unconditionally sets and signals a RuntimeException
     WRAP = 2     # appends modified type wrapped in list to global event list
 
-    # duplicating the C constant
-    TYPE_MAX_WATCHERS = 8
+    _add_watcher = staticmethod(_testcapi.add_type_watcher)
+    _clear_watcher = staticmethod(_testcapi.clear_type_watcher)
+    _watch = staticmethod(_testcapi.watch_type)
+    _unwatch = staticmethod(_testcapi.unwatch_type)
 
     def add_watcher(self, kind=TYPES):
-        return _testcapi.add_type_watcher(kind)
+        return self._add_watcher(kind)
 
     def clear_watcher(self, watcher_id):
-        _testcapi.clear_type_watcher(watcher_id)
+        self._clear_watcher(watcher_id)
 
-    @contextmanager
     def watcher(self, kind=TYPES):
-        wid = self.add_watcher(kind)
-        try:
-            yield wid
-        finally:
-            self.clear_watcher(wid)
+        return _WatcherCM(self.add_watcher, self.clear_watcher, kind)
 
     def assert_events(self, expected):
         actual = _testcapi.get_type_modified_events()
         self.assertEqual(actual, expected)
 
+    def _fresh_type(self):
+        return type("C", (), {})
+
+    def _shared_type(self, cls):
+        # Reuse a module-level type.  Attributes added by the test are
+        # removed again after its watchers have been cleared; tests must
+        # also unwatch the type before that.
+        keys = set(vars(cls))
+        self.addCleanup(self._restore_type, cls, keys)
+        return cls
+
+    @staticmethod
+    def _restore_type(cls, keys):
+        for name in set(vars(cls)) - keys:
+            delattr(cls, name)
+
     def watch(self, wid, t):
-        _testcapi.watch_type(wid, t)
+        self._watch(wid, t)
 
     def unwatch(self, wid, t):
-        _testcapi.unwatch_type(wid, t)
+        self._unwatch(wid, t)
 
     def test_watch_type(self):
-        class C: pass
-        with self.watcher() as wid:
-            self.watch(wid, C)
-            C.foo = "bar"
-            self.assert_events([C])
+        C = self._fresh_type()
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, C)
+        C.foo = "bar"
+        self.assert_events([C])
 
     def test_event_aggregation(self):
-        class C: pass
-        with self.watcher() as wid:
-            self.watch(wid, C)
-            C.foo = "bar"
-            C.bar = "baz"
-            # only one event registered for both modifications
-            self.assert_events([C])
+        C = self._fresh_type()
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, C)
+        C.foo = "bar"
+        C.bar = "baz"
+        # only one event registered for both modifications
+        self.assert_events([C])
 
     def test_lookup_resets_aggregation(self):
-        class C: pass
-        with self.watcher() as wid:
-            self.watch(wid, C)
-            C.foo = "bar"
-            # lookup resets type version tag
-            self.assertEqual(C.foo, "bar")
-            C.bar = "baz"
-            # both events registered
-            self.assert_events([C, C])
+        C = self._fresh_type()
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, C)
+        C.foo = "bar"
+        # lookup resets type version tag
+        self.assertEqual(C.foo, "bar")
+        C.bar = "baz"
+        # both events registered
+        self.assert_events([C, C])
 
     def test_unwatch_type(self):
-        class C: pass
+        C = self._fresh_type()
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, C)
+        C.foo = "bar"
+        self.assertEqual(C.foo, "bar")
+        self.assert_events([C])
+        self.unwatch(wid, C)
+        C.bar = "baz"
+        self.assert_events([C])
+
+    def test_clear_watcher(self):
+        C = self._fresh_type()
+        # outer watcher is unused, it's just to keep events list alive
+        self.addCleanup(self.clear_watcher, self.add_watcher())
         with self.watcher() as wid:
             self.watch(wid, C)
             C.foo = "bar"
             self.assertEqual(C.foo, "bar")
             self.assert_events([C])
-            self.unwatch(wid, C)
-            C.bar = "baz"
-            self.assert_events([C])
-
-    def test_clear_watcher(self):
-        class C: pass
-        # outer watcher is unused, it's just to keep events list alive
-        with self.watcher() as _:
-            with self.watcher() as wid:
-                self.watch(wid, C)
-                C.foo = "bar"
-                self.assertEqual(C.foo, "bar")
-                self.assert_events([C])
-            C.bar = "baz"
-            # Watcher on C has been cleared, no new event
-            self.assert_events([C])
+        C.bar = "baz"
+        # Watcher on C has been cleared, no new event
+        self.assert_events([C])
 
     def test_watch_type_subclass(self):
-        class C: pass
-        class D(C): pass
-        with self.watcher() as wid:
-            self.watch(wid, D)
-            C.foo = "bar"
-            self.assert_events([D])
+        C = self._shared_type(_C)
+        D = _D
+        wid = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, D)
+        # unwatch the shared type before its watcher is cleared
+        self.addCleanup(self.unwatch, wid, D)
+        C.foo = "bar"
+        self.assert_events([D])
 
     def test_error(self):
-        class C: pass
-        with self.watcher(kind=self.ERROR) as wid:
-            self.watch(wid, C)
-            with catch_unraisable_exception() as cm:
-                C.foo = "bar"
-                self.assertIs(cm.unraisable.object, C)
-                self.assertEqual(str(cm.unraisable.exc_value), "boom!")
-            self.assert_events([])
+        C = self._fresh_type()
+        unraisable = self.catch_unraisable()
+        wid = self.add_watcher(kind=self.ERROR)
+        self.addCleanup(self.clear_watcher, wid)
+        self.watch(wid, C)
+        C.foo = "bar"
+        self.assertIsNotNone(unraisable.last)
+        self.assertIs(unraisable.last.object, C)
+        self.assertEqual(str(unraisable.last.exc_value), "boom!")
+        self.assert_events([])
 
     def test_two_watchers(self):
-        class C1: pass
-        class C2: pass
-        with self.watcher() as wid1:
-            with self.watcher(kind=self.WRAP) as wid2:
-                self.assertNotEqual(wid1, wid2)
-                self.watch(wid1, C1)
-                self.watch(wid2, C2)
-                C1.foo = "bar"
-                C2.hmm = "baz"
-                self.assert_events([C1, [C2]])
-
-    def test_watch_non_type(self):
+        C1 = self._shared_type(_C1)
+        C2 = self._shared_type(_C2)
+        wid1 = self.add_watcher()
+        self.addCleanup(self.clear_watcher, wid1)
+        wid2 = self.add_watcher(kind=self.WRAP)
+        self.addCleanup(self.clear_watcher, wid2)
+        self.assertNotEqual(wid1, wid2)
+        self.watch(wid1, C1)
+        self.addCleanup(self.unwatch, wid1, C1)
+        self.watch(wid2, C2)
+        self.addCleanup(self.unwatch, wid2, C2)
+        C1.foo = "bar"
+        C2.hmm = "baz"
+        self.assert_events([C1, [C2]])
+
+    def test_api_errors(self):
         with self.watcher() as wid:
-            with self.assertRaisesRegex(ValueError, r"Cannot watch non-type"):
-                self.watch(wid, 1)
-
-    def test_watch_out_of_range_watcher_id(self):
-        class C: pass
-        with self.assertRaisesRegex(ValueError, r"Invalid type watcher ID -1"):
-            self.watch(-1, C)
-        with self.assertRaisesRegex(ValueError, r"Invalid type watcher ID 8"):
-            self.watch(self.TYPE_MAX_WATCHERS, C)
-
-    def test_watch_unassigned_watcher_id(self):
-        class C: pass
-        with self.assertRaisesRegex(ValueError, r"No type watcher set for ID 1"):
-            self.watch(1, C)
-
-    def test_unwatch_non_type(self):
-        with self.watcher() as wid:
-            with self.assertRaisesRegex(ValueError, r"Cannot watch non-type"):
-                self.unwatch(wid, 1)
-
-    def test_unwatch_out_of_range_watcher_id(self):
-        class C: pass
-        with self.assertRaisesRegex(ValueError, r"Invalid type watcher ID -1"):
-            self.unwatch(-1, C)
-        with self.assertRaisesRegex(ValueError, r"Invalid type watcher ID 8"):
-            self.unwatch(self.TYPE_MAX_WATCHERS, C)
-
-    def test_unwatch_unassigned_watcher_id(self):
-        class C: pass
-        with self.assertRaisesRegex(ValueError, r"No type watcher set for ID 1"):
-            self.unwatch(1, C)
-
-    def test_clear_out_of_range_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"Invalid type watcher ID -1"):
-            self.clear_watcher(-1)
-        with self.assertRaisesRegex(ValueError, r"Invalid type watcher ID 8"):
-            self.clear_watcher(self.TYPE_MAX_WATCHERS)
-
-    def test_clear_unassigned_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"No type watcher set for ID 1"):
-            self.clear_watcher(1)
+            for func in (self.watch, self.unwatch):
+                with self.subTest(func=func.__name__):
+                    self.assert_raises_msg(
+                        ValueError, "Cannot watch non-type", func, wid, 1)
 
     def test_no_more_ids_available(self):
-        contexts = [self.watcher() for i in range(self.TYPE_MAX_WATCHERS)]
-        with ExitStack() as stack:
-            for ctx in contexts:
-                stack.enter_context(ctx)
-            with self.assertRaisesRegex(RuntimeError, r"no more type watcher IDs"):
-                self.add_watcher()
+        ids = _testcapi.fill_type_watchers()
+        try:
+            self.assert_raises_msg(
+                RuntimeError, "no more type watcher IDs available",
+                self.add_watcher)
+        finally:
+            _testcapi.clear_all_type_watchers(ids)
+
+
+class TestWatcherIDErrors(_WatcherTestCase):
+    def test_error_matrix(self):
+        # out-of-range and unassigned watcher IDs for the dict and type
+        # watcher APIs; _testcapi derives the cases from the C constants and
+        # watches a throwaway type rather than a shared one
+        matrix = _testcapi.watcher_error_matrix(type("C", (), {}))
+        for api, args, exc, msg in matrix:
+            with self.subTest(api=api, args=args):
+                self.assert_raises_msg(exc, msg, getattr(_testcapi, api), *args)
+
 
+class TestCodeObjectWatchers(_WatcherTestCase):
+    _add_watcher = staticmethod(_testcapi.add_code_watcher)
+    _clear_watcher = staticmethod(_testcapi.clear_code_watcher)
+
+    def setUp(self):
+        _testcapi.reset_code_watcher_counts()
 
-class TestCodeObjectWatchers(unittest.TestCase):
-    @contextmanager
     def code_watcher(self, which_watcher):
-        wid = _testcapi.add_code_watcher(which_watcher)
-        try:
-            yield wid
-        finally:
-            _testcapi.clear_code_watcher(wid)
+        return _WatcherCM(self._add_watcher, self._clear_watcher, which_watcher)
 
     def assert_event_counts(self, exp_created_0, exp_destroyed_0,
                             exp_created_1, exp_destroyed_1):
@@ -356,98 +497,125 @@ def assert_event_counts(self, exp_created_0, exp_destroyed_0,
         self.assertEqual(
             exp_destroyed_1, _testcapi.get_code_watcher_num_destroyed_events(1))
 
-    def test_code_object_events_dispatched(self):
-        # verify that all counts are zero before any watchers are registered
-        self.assert_event_counts(0, 0, 0, 0)
+    def new_code(self, name):
+        return _testcapi.code_newempty("test_watchers", name, 0)
 
+    def test_no_watchers(self):
         # verify that all counts remain zero when a code object is
         # created and destroyed with no watchers registered
-        co1 = _testcapi.code_newempty("test_watchers", "dummy1", 0)
         self.assert_event_counts(0, 0, 0, 0)
-        del co1
+        co = self.new_code("no_watchers")
+        self.assert_event_counts(0, 0, 0, 0)
+        del co
         self.assert_event_counts(0, 0, 0, 0)
 
-        # verify counts are as expected when first watcher is registered
+    def test_create_event(self):
+        wid = self._add_watcher(0)
+        self.addCleanup(self._clear_watcher, wid)
+        self.assert_event_counts(0, 0, 0, 0)
+        co1 = self.new_code("create1")
+        self.assert_event_counts(1, 0, 0, 0)
+        # every creation is counted while earlier objects are still alive
+        co2 = self.new_code("create2")
+        self.assert_event_counts(2, 0, 0, 0)
+
+    def test_destroy_event(self):
+        wid = self._add_watcher(0)
+        self.addCleanup(self._clear_watcher, wid)
+        co = self.new_code("destroy")
+        self.assert_event_counts(1, 0, 0, 0)
+        del co
+        self.assert_event_counts(1, 1, 0, 0)
+
+    def test_two_watchers(self):
         with self.code_watcher(0):
-            self.assert_event_counts(0, 0, 0, 0)
-            co2 = _testcapi.code_newempty("test_watchers", "dummy2", 0)
-            self.assert_event_counts(1, 0, 0, 0)
+            co2 = self.new_code("first_watcher")
             del co2
             self.assert_event_counts(1, 1, 0, 0)
 
             # again with second watcher registered
             with self.code_watcher(1):
                 self.assert_event_counts(1, 1, 0, 0)
-                co3 = _testcapi.code_newempty("test_watchers", "dummy3", 0)
+                co3 = self.new_code("second_watcher")
                 self.assert_event_counts(2, 1, 1, 0)
                 del co3
                 self.assert_event_counts(2, 2, 1, 1)
 
         # verify counts remain as they were after both watchers are cleared
-        co4 = _testcapi.code_newempty("test_watchers", "dummy4", 0)
+        co4 = self.new_code("cleared_watchers")
         self.assert_event_counts(2, 2, 1, 1)
         del co4
         self.assert_event_counts(2, 2, 1, 1)
 
-    def test_clear_out_of_range_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"Invalid code watcher ID -1"):
-            _testcapi.clear_code_watcher(-1)
-        with self.assertRaisesRegex(ValueError, r"Invalid code watcher ID 8"):
-            _testcapi.clear_code_watcher(8)  # CODE_MAX_WATCHERS = 8
-
-    def test_clear_unassigned_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"No code watcher set for ID 1"):
-            _testcapi.clear_code_watcher(1)
+    def test_api_errors(self):
+        max_watchers = _testcapi.CODE_MAX_WATCHERS
+        for wid, msg in (
+            (-1, "Invalid code watcher ID -1"),
+            (max_watchers, f"Invalid code watcher ID {max_watchers}"),
+            (1, "No code watcher set for ID 1"),
+        ):
+            with self.subTest(wid=wid):
+                self.assert_raises_msg(ValueError, msg, self._clear_watcher, wid)
 
     def test_allocate_too_many_watchers(self):
-        with self.assertRaisesRegex(RuntimeError, r"no more code watcher IDs available"):
-            _testcapi.allocate_too_many_code_watchers()
+        self.assert_raises_msg(
+            RuntimeError, "no more code watcher IDs available",
+            _testcapi.allocate_too_many_code_watchers)
 
 
-class TestFuncWatchers(unittest.TestCase):
-    @contextmanager
-    def add_watcher(self, func):
-        wid = _testcapi.add_func_watcher(func)
-        try:
-            yield
-        finally:
-            _testcapi.clear_func_watcher(wid)
+class TestFuncWatchers(_WatcherTestCase):
+    EVT_CREATE = _testcapi.PYFUNC_EVENT_CREATE
+    EVT_DESTROY = _testcapi.PYFUNC_EVENT_DESTROY
+    EVT_MOD_CODE = _testcapi.PYFUNC_EVENT_MODIFY_CODE
+    EVT_MOD_DEFAULTS = _testcapi.PYFUNC_EVENT_MODIFY_DEFAULTS
+    EVT_MOD_KWDEFAULTS = _testcapi.PYFUNC_EVENT_MODIFY_KWDEFAULTS
+
+    _add_watcher = staticmethod(_testcapi.add_func_watcher)
+    _clear_watcher = staticmethod(_testcapi.clear_func_watcher)
 
     def test_func_events_dispatched(self):
-        events = []
+        # all events are hashable except MODIFY_KWDEFAULTS, whose value is
+        # a dict; track those separately so the rest can be looked up in a set
+        events = set()
+        kwdefaults_events = []
         def watcher(*args):
-            events.append(args)
-
-        with self.add_watcher(watcher):
-            def myfunc():
-                pass
-            self.assertIn((_testcapi.PYFUNC_EVENT_CREATE, myfunc, None), events)
-            myfunc_id = id(myfunc)
+            if args[0] == self.EVT_MOD_KWDEFAULTS:
+                kwdefaults_events.append(args)
+            else:
+                events.add(args)
+
+        wid = self._add_watcher(watcher)
+        self.addCleanup(self._clear_watcher, wid)
+        def myfunc():
+            pass
+        self.assertIn((self.EVT_CREATE, myfunc, None), events)
+        myfunc_id = id(myfunc)
 
-            new_code = self.test_func_events_dispatched.__code__
-            myfunc.__code__ = new_code
-            self.assertIn((_testcapi.PYFUNC_EVENT_MODIFY_CODE, myfunc, new_code), events)
+        new_code = self.test_func_events_dispatched.__code__
+        myfunc.__code__ = new_code
+        self.assertIn((self.EVT_MOD_CODE, myfunc, new_code), events)
 
-            new_defaults = (123,)
-            myfunc.__defaults__ = new_defaults
-            self.assertIn((_testcapi.PYFUNC_EVENT_MODIFY_DEFAULTS, myfunc, new_defaults), events)
+        new_defaults = (123,)
+        myfunc.__defaults__ = new_defaults
+        self.assertIn((self.EVT_MOD_DEFAULTS, myfunc, new_defaults), events)
 
-            new_defaults = (456,)
-            _testcapi.set_func_defaults_via_capi(myfunc, new_defaults)
-            self.assertIn((_testcapi.PYFUNC_EVENT_MODIFY_DEFAULTS, myfunc, new_defaults), events)
+        new_defaults = (456,)
+        _testcapi.set_func_defaults_via_capi(myfunc, new_defaults)
+        self.assertIn((self.EVT_MOD_DEFAULTS, myfunc, new_defaults), events)
 
-            new_kwdefaults = {"self": 123}
-            myfunc.__kwdefaults__ = new_kwdefaults
-            self.assertIn((_testcapi.PYFUNC_EVENT_MODIFY_KWDEFAULTS, myfunc, new_kwdefaults), events)
+        new_kwdefaults = {"self": 123}
+        myfunc.__kwdefaults__ = new_kwdefaults
+        self.assertIn((self.EVT_MOD_KWDEFAULTS, myfunc, new_kwdefaults), kwdefaults_events)
 
-            new_kwdefaults = {"self": 456}
-            _testcapi.set_func_kwdefaults_via_capi(myfunc, new_kwdefaults)
-            self.assertIn((_testcapi.PYFUNC_EVENT_MODIFY_KWDEFAULTS, myfunc, new_kwdefaults), events)
+        new_kwdefaults = {"self": 456}
+        _testcapi.set_func_kwdefaults_via_capi(myfunc, new_kwdefaults)
+        self.assertIn((self.EVT_MOD_KWDEFAULTS, myfunc, new_kwdefaults), kwdefaults_events)
 
-            # Clear events reference to func
-            events = []
-            del myfunc
-            self.assertIn((_testcapi.PYFUNC_EVENT_DESTROY, myfunc_id, None), events)
+        # Clear events reference to func
+        events = set()
+        kwdefaults_events = []
+        del myfunc
+        self.assertIn((self.EVT_DESTROY, myfunc_id, None), events)
 
     def test_multiple_watchers(self):
         events0 = []
@@ -458,14 +626,16 @@ def first_watcher(*args):
         def second_watcher(*args):
             events1.append(args)
 
-        with self.add_watcher(first_watcher):
-            with self.add_watcher(second_watcher):
-                def myfunc():
-                    pass
+        wid0 = self._add_watcher(first_watcher)
+        self.addCleanup(self._clear_watcher, wid0)
+        wid1 = self._add_watcher(second_watcher)
+        self.addCleanup(self._clear_watcher, wid1)
+        def myfunc():
+            pass
 
-                event = (_testcapi.PYFUNC_EVENT_CREATE, myfunc, None)
-                self.assertIn(event, events0)
-                self.assertIn(event, events1)
+        event = (self.EVT_CREATE, myfunc, None)
+        self.assertIn(event, events0)
+        self.assertIn(event, events1)
 
     def test_watcher_raises_error(self):
         class MyError(Exception):
@@ -474,27 +644,30 @@ class MyError(Exception):
         def watcher(*args):
             raise MyError("testing 123")
 
-        with self.add_watcher(watcher):
-            with catch_unraisable_exception() as cm:
-                def myfunc():
-                    pass
-
-                self.assertIs(cm.unraisable.object, myfunc)
-                self.assertIsInstance(cm.unraisable.exc_value, MyError)
+        unraisable = self.catch_unraisable()
+        wid = self._add_watcher(watcher)
+        self.addCleanup(self._clear_watcher, wid)
+        def myfunc():
+            pass
 
-    def test_clear_out_of_range_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"invalid func watcher ID -1"):
-            _testcapi.clear_func_watcher(-1)
-        with self.assertRaisesRegex(ValueError, r"invalid func watcher ID 8"):
-            _testcapi.clear_func_watcher(8)  # FUNC_MAX_WATCHERS = 8
+        self.assertIsNotNone(unraisable.last)
+        self.assertIs(unraisable.last.object, myfunc)
+        self.assertIsInstance(unraisable.last.exc_value, MyError)
 
-    def test_clear_unassigned_watcher_id(self):
-        with self.assertRaisesRegex(ValueError, r"no func watcher set for ID 1"):
-            _testcapi.clear_func_watcher(1)
+    def test_api_errors(self):
+        max_watchers = _testcapi.FUNC_MAX_WATCHERS
+        for wid, msg in (
+            (-1, "invalid func watcher ID -1"),
+            (max_watchers, f"invalid func watcher ID {max_watchers}"),
+            (1, "no func watcher set for ID 1"),
+        ):
+            with self.subTest(wid=wid):
+                self.assert_raises_msg(ValueError, msg, self._clear_watcher, wid)
 
     def test_allocate_too_many_watchers(self):
-        with self.assertRaisesRegex(RuntimeError, r"no more func watcher IDs"):
-            _testcapi.allocate_too_many_func_watchers()
+        self.assert_raises_msg(
+            RuntimeError, "no more func watcher IDs available",
+            _testcapi.allocate_too_many_func_watchers)
 
 
 if __name__ == "__main__":
@@ -1,51 +1,72 @@
 #include "parts.h"
 
 #define Py_BUILD_CORE
+#include "pycore_dict_state.h"  // DICT_MAX_WATCHERS
 #include "pycore_function.h"  // FUNC_MAX_WATCHERS
 #include "pycore_code.h"  // CODE_MAX_WATCHERS
 
 // Test dict watching
-static PyObject *g_dict_watch_events;
+
+// Dict events are kept in a fixed-size ring buffer; once it is full, the
+// oldest event is dropped to make room for the newest one and counted in
+// g_dict_watch_events_dropped.
+#define DICT_WATCH_EVENTS_SIZE 256
+static PyObject *g_dict_watch_events[DICT_WATCH_EVENTS_SIZE];
+static Py_ssize_t g_dict_watch_events_start;
+static Py_ssize_t g_dict_watch_events_len;
+static Py_ssize_t g_dict_watch_events_dropped;
 static int g_dict_watchers_installed;
 
+static void
+append_dict_watch_event(PyObject *event)
+{
+    // Steals a reference to event.
+    Py_ssize_t idx = ((g_dict_watch_events_start + g_dict_watch_events_len)
+                      % DICT_WATCH_EVENTS_SIZE);
+    if (g_dict_watch_events_len < DICT_WATCH_EVENTS_SIZE) {
+        g_dict_watch_events[idx] = event;
+        g_dict_watch_events_len++;
+        return;
+    }
+    // Update the buffer before releasing the dropped event, which may
+    // trigger further dict events.
+    PyObject *oldest = g_dict_watch_events[idx];
+    g_dict_watch_events[idx] = event;
+    g_dict_watch_events_start = (idx + 1) % DICT_WATCH_EVENTS_SIZE;
+    g_dict_watch_events_dropped++;
+    Py_DECREF(oldest);
+}
+
+static void
+clear_dict_watch_events(void)
+{
+    while (g_dict_watch_events_len > 0) {
+        Py_ssize_t idx = g_dict_watch_events_start;
+        PyObject *event = g_dict_watch_events[idx];
+        g_dict_watch_events[idx] = NULL;
+        g_dict_watch_events_start = (idx + 1) % DICT_WATCH_EVENTS_SIZE;
+        g_dict_watch_events_len--;
+        Py_DECREF(event);
+    }
+    g_dict_watch_events_start = 0;
+    g_dict_watch_events_dropped = 0;
+}
+
 static int
 dict_watch_callback(PyDict_WatchEvent event,
                     PyObject *dict,
                     PyObject *key,
                     PyObject *new_value)
 {
-    PyObject *msg;
-    switch (event) {
-        case PyDict_EVENT_CLEARED:
-            msg = PyUnicode_FromString("clear");
-            break;
-        case PyDict_EVENT_DEALLOCATED:
-            msg = PyUnicode_FromString("dealloc");
-            break;
-        case PyDict_EVENT_CLONED:
-            msg = PyUnicode_FromString("clone");
-            break;
-        case PyDict_EVENT_ADDED:
-            msg = PyUnicode_FromFormat("new:%S:%S", key, new_value);
-            break;
-        case PyDict_EVENT_MODIFIED:
-            msg = PyUnicode_FromFormat("mod:%S:%S", key, new_value);
-            break;
-        case PyDict_EVENT_DELETED:
-            msg = PyUnicode_FromFormat("del:%S", key);
-            break;
-        default:
-            msg = PyUnicode_FromString("unknown");
-    }
+    // Record (event, key, new_value); key and new_value are NULL for some
+    // events and are recorded as None in that case.
+    PyObject *msg = Py_BuildValue("(iOO)", (int)event,
+                                  key ? key : Py_None,
+                                  new_value ? new_value : Py_None);
     if (msg == NULL) {
         return -1;
     }
-    assert(PyList_Check(g_dict_watch_events));
-    if (PyList_Append(g_dict_watch_events, msg) < 0) {
-        Py_DECREF(msg);
-        return -1;
-    }
-    Py_DECREF(msg);
+    append_dict_watch_event(msg);
     return 0;
 }
 
@@ -59,11 +80,7 @@ dict_watch_callback_second(PyDict_WatchEvent event,
     if (msg == NULL) {
         return -1;
     }
-    int rc = PyList_Append(g_dict_watch_events, msg);
-    Py_DECREF(msg);
-    if (rc < 0) {
-        return -1;
-    }
+    append_dict_watch_event(msg);
     return 0;
 }
 
@@ -95,12 +112,7 @@ add_dict_watcher(PyObject *self, PyObject *kind)
     if (watcher_id < 0) {
         return NULL;
     }
-    if (!g_dict_watchers_installed) {
-        assert(!g_dict_watch_events);
-        if (!(g_dict_watch_events = PyList_New(0))) {
-            return NULL;
-        }
-    }
+    assert(g_dict_watchers_installed || !g_dict_watch_events_len);
     g_dict_watchers_installed++;
     return PyLong_FromLong(watcher_id);
 }
@@ -113,8 +125,7 @@ clear_dict_watcher(PyObject *self, PyObject *watcher_id)
     }
     g_dict_watchers_installed--;
     if (!g_dict_watchers_installed) {
-        assert(g_dict_watch_events);
-        Py_CLEAR(g_dict_watch_events);
+        clear_dict_watch_events();
     }
     Py_RETURN_NONE;
 }
@@ -150,11 +161,68 @@ unwatch_dict(PyObject *self, PyObject *args)
 static PyObject *
 get_dict_watcher_events(PyObject *self, PyObject *Py_UNUSED(args))
 {
-    if (!g_dict_watch_events) {
+    if (!g_dict_watchers_installed) {
+        PyErr_SetString(PyExc_RuntimeError, "no watchers active");
+        return NULL;
+    }
+    PyObject *events = PyList_New(g_dict_watch_events_len);
+    if (events == NULL) {
+        return NULL;
+    }
+    for (Py_ssize_t i = 0; i < g_dict_watch_events_len; i++) {
+        Py_ssize_t idx = ((g_dict_watch_events_start + i)
+                          % DICT_WATCH_EVENTS_SIZE);
+        PyList_SET_ITEM(events, i, Py_NewRef(g_dict_watch_events[idx]));
+    }
+    return events;
+}
+
+static PyObject *
+get_dict_watcher_dropped_events(PyObject *self, PyObject *Py_UNUSED(args))
+{
+    if (!g_dict_watchers_installed) {
         PyErr_SetString(PyExc_RuntimeError, "no watchers active");
         return NULL;
     }
-    return Py_NewRef(g_dict_watch_events);
+    return PyLong_FromSsize_t(g_dict_watch_events_dropped);
+}
+
+static PyObject *
+reset_dict_watcher_events(PyObject *self, PyObject *Py_UNUSED(args))
+{
+    clear_dict_watch_events();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+dict_watcher_events_empty(PyObject *self, PyObject *Py_UNUSED(args))
+{
+    if (!g_dict_watchers_installed) {
+        PyErr_SetString(PyExc_RuntimeError, "no watchers active");
+        return NULL;
+    }
+    return PyBool_FromLong(g_dict_watch_events_len == 0);
+}
+
+static PyObject *
+watch_dict_and_dealloc(PyObject *self, PyObject *watcher_id)
+{
+    // Watch a dict that only C code holds a reference to, so that it is
+    // deallocated as soon as that reference is dropped.
+    int wid = _PyLong_AsInt(watcher_id);
+    if (wid == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    PyObject *dict = PyDict_New();
+    if (dict == NULL) {
+        return NULL;
+    }
+    if (PyDict_Watch(wid, dict)) {
+        Py_DECREF(dict);
+        return NULL;
+    }
+    Py_DECREF(dict);
+    return get_dict_watcher_events(self, NULL);
 }
 
 // Test type watchers
@@ -278,6 +346,170 @@ unwatch_type(PyObject *self, PyObject *args)
     Py_RETURN_NONE;
 }
 
+static int
+noop_type_modified_callback(PyTypeObject *type)
+{
+    return 0;
+}
+
+static PyObject *
+fill_type_watchers(PyObject *self, PyObject *Py_UNUSED(args))
+{
+    PyObject *ids = PyList_New(0);
+    if (ids == NULL) {
+        return NULL;
+    }
+    for (int i = 0; i < TYPE_MAX_WATCHERS; i++) {
+        int watcher_id = PyType_AddWatcher(noop_type_modified_callback);
+        if (watcher_id < 0) {
+            // all remaining IDs are taken
+            PyErr_Clear();
+            break;
+        }
+        PyObject *id_obj = PyLong_FromLong(watcher_id);
+        if (id_obj == NULL) {
+            PyType_ClearWatcher(watcher_id);
+            goto error;
+        }
+        int rc = PyList_Append(ids, id_obj);
+        Py_DECREF(id_obj);
+        if (rc < 0) {
+            PyType_ClearWatcher(watcher_id);
+            goto error;
+        }
+    }
+    return ids;
+
+error:
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(ids); i++) {
+        PyType_ClearWatcher(PyLong_AsLong(PyList_GET_ITEM(ids, i)));
+    }
+    Py_DECREF(ids);
+    return NULL;
+}
+
+static PyObject *
+clear_all_type_watchers(PyObject *self, PyObject *ids)
+{
+    if (!PyList_Check(ids)) {
+        PyErr_SetString(PyExc_TypeError, "'ids' must be a list");
+        return NULL;
+    }
+    // Clear every ID even if some fail; report the first error.
+    PyObject *type = NULL, *value = NULL, *traceback = NULL;
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(ids); i++) {
+        int watcher_id = _PyLong_AsInt(PyList_GET_ITEM(ids, i));
+        if (watcher_id != -1 || !PyErr_Occurred()) {
+            PyType_ClearWatcher(watcher_id);
+        }
+        if (PyErr_Occurred()) {
+            if (type == NULL) {
+                PyErr_Fetch(&type, &value, &traceback);
+            }
+            else {
+                PyErr_Clear();
+            }
+        }
+    }
+    if (type) {
+        PyErr_Restore(type, value, traceback);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+// Test watcher ID validation
+
+static int
+add_watcher_errors(PyObject *matrix, const char *kind, int max_watchers,
+                   const char *watch, const char *unwatch, const char *clear,
+                   PyObject *target)
+{
+    // ID 1 is assumed not to be assigned while the matrix is checked.
+    int watcher_ids[] = {-1, max_watchers, 1};
+    const char *apis[] = {watch, unwatch, clear};
+    for (size_t i = 0; i < Py_ARRAY_LENGTH(watcher_ids); i++) {
+        int wid = watcher_ids[i];
+        PyObject *msg;
+        if (wid == 1) {
+            msg = PyUnicode_FromFormat("No %s watcher set for ID %d",
+                                       kind, wid);
+        }
+        else {
+            msg = PyUnicode_FromFormat("Invalid %s watcher ID %d", kind, wid);
+        }
+        if (msg == NULL) {
+            return -1;
+        }
+        for (size_t j = 0; j < Py_ARRAY_LENGTH(apis); j++) {
+            PyObject *args;
+            if (apis[j] == clear) {
+                args = Py_BuildValue("(i)", wid);
+            }
+            else {
+                args = Py_BuildValue("(iO)", wid, target);
+            }
+            if (args == NULL) {
+                Py_DECREF(msg);
+                return -1;
+            }
+            PyObject *entry = Py_BuildValue("(sNOO)", apis[j], args,
+                                            PyExc_ValueError, msg);
+            if (entry == NULL) {
+                Py_DECREF(msg);
+                return -1;
+            }
+            int rc = PyList_Append(matrix, entry);
+            Py_DECREF(entry);
+            if (rc < 0) {
+                Py_DECREF(msg);
+                return -1;
+            }
+        }
+        Py_DECREF(msg);
+    }
+    return 0;
+}
+
+static PyObject *
+watcher_error_matrix(PyObject *self, PyObject *type)
+{
+    // Return a list of (api_name, args, exception_type, message) tuples for
+    // calls that must fail with an out-of-range or unassigned watcher ID.
+    // The type cases watch *type*, which should be a throwaway heap type so
+    // that a call that unexpectedly succeeds can't leave a static type
+    // watched.
+    if (!PyType_Check(type)) {
+        PyErr_SetString(PyExc_TypeError, "expected a type");
+        return NULL;
+    }
+    PyObject *matrix = PyList_New(0);
+    if (matrix == NULL) {
+        return NULL;
+    }
+    PyObject *dict = PyDict_New();
+    if (dict == NULL) {
+        goto error;
+    }
+    int rc = add_watcher_errors(matrix, "dict", DICT_MAX_WATCHERS,
+                                "watch_dict", "unwatch_dict",
+                                "clear_dict_watcher", dict);
+    Py_DECREF(dict);
+    if (rc < 0) {
+        goto error;
+    }
+    if (add_watcher_errors(matrix, "type", TYPE_MAX_WATCHERS,
+                           "watch_type", "unwatch_type",
+                           "clear_type_watcher", type) < 0) {
+        goto error;
+    }
+    return matrix;
+
+error:
+    Py_DECREF(matrix);
+    return NULL;
+}
 
 // Test code object watching
 
@@ -367,6 +599,16 @@ get_code_watcher_num_destroyed_events(PyObject *self, PyObject *watcher_id)
     return PyLong_FromLong(num_code_object_destroyed_events[watcher_id_l]);
 }
 
+static PyObject *
+reset_code_watcher_counts(PyObject *self, PyObject *Py_UNUSED(args))
+{
+    for (int i = 0; i < NUM_CODE_WATCHERS; i++) {
+        num_code_object_created_events[i] = 0;
+        num_code_object_destroyed_events[i] = 0;
+    }
+    Py_RETURN_NONE;
+}
+
 static PyObject *
 allocate_too_many_code_watchers(PyObject *self, PyObject *args)
 {
@@ -622,6 +864,11 @@ static PyMethodDef test_methods[] = {
     {"watch_dict",               watch_dict,              METH_VARARGS, NULL},
     {"unwatch_dict",             unwatch_dict,            METH_VARARGS, NULL},
     {"get_dict_watcher_events",  get_dict_watcher_events, METH_NOARGS,  NULL},
+    {"dict_watcher_events_empty", dict_watcher_events_empty, METH_NOARGS, NULL},
+    {"reset_dict_watcher_events", reset_dict_watcher_events, METH_NOARGS, NULL},
+    {"get_dict_watcher_dropped_events", get_dict_watcher_dropped_events,
+     METH_NOARGS, NULL},
+    {"watch_dict_and_dealloc",   watch_dict_and_dealloc,  METH_O,       NULL},
 
     // Type watchers.
     {"add_type_watcher",         add_type_watcher,        METH_O,       NULL},
@@ -629,6 +876,11 @@ static PyMethodDef test_methods[] = {
     {"watch_type",               watch_type,              METH_VARARGS, NULL},
     {"unwatch_type",             unwatch_type,            METH_VARARGS, NULL},
     {"get_type_modified_events", get_type_modified_events, METH_NOARGS, NULL},
+    {"fill_type_watchers",       fill_type_watchers,      METH_NOARGS,  NULL},
+    {"clear_all_type_watchers",  clear_all_type_watchers, METH_O,       NULL},
+
+    // Watcher ID validation.
+    {"watcher_error_matrix",     watcher_error_matrix,    METH_O,       NULL},
 
     // Code object watchers.
     {"add_code_watcher",         add_code_watcher,        METH_O,       NULL},
@@ -637,6 +889,7 @@ static PyMethodDef test_methods[] = {
      get_code_watcher_num_created_events,                 METH_O,       NULL},
     {"get_code_watcher_num_destroyed_events",
      get_code_watcher_num_destroyed_events,               METH_O,       NULL},
+    {"reset_code_watcher_counts", reset_code_watcher_counts, METH_NOARGS, NULL},
     {"allocate_too_many_code_watchers",
      (PyCFunction) allocate_too_many_code_watchers,       METH_NOARGS,  NULL},
 
@@ -666,5 +919,33 @@ _PyTestCapi_Init_Watchers(PyObject *mod)
     FOREACH_FUNC_EVENT(ADD_EVENT);
 #undef ADD_EVENT
 
+#define ADD_DICT_EVENT(event)  \
+    if (PyModule_AddIntConstant(mod, "PYDICT_EVENT_" #event,  \
+                                PyDict_EVENT_##event)) {     \
+        return -1;                                           \
+    }
+    ADD_DICT_EVENT(ADDED);
+    ADD_DICT_EVENT(MODIFIED);
+    ADD_DICT_EVENT(DELETED);
+    ADD_DICT_EVENT(CLONED);
+    ADD_DICT_EVENT(CLEARED);
+    ADD_DICT_EVENT(DEALLOCATED);
+#undef ADD_DICT_EVENT
+
+#define ADD_MAX_WATCHERS(name)  \
+    if (PyModule_AddIntConstant(mod, #name, name)) {  \
+        return -1;                                    \
+    }
+    ADD_MAX_WATCHERS(DICT_MAX_WATCHERS);
+    ADD_MAX_WATCHERS(TYPE_MAX_WATCHERS);
+    ADD_MAX_WATCHERS(CODE_MAX_WATCHERS);
+    ADD_MAX_WATCHERS(FUNC_MAX_WATCHERS);
+#undef ADD_MAX_WATCHERS
+
+    if (PyModule_AddIntConstant(mod, "DICT_WATCH_EVENTS_SIZE",
+                                DICT_WATCH_EVENTS_SIZE)) {
+        return -1;
+    }
+
     return 0;
 }